@@ -1,7 +1,9 @@
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-from PySide6.QtCore import QObject, Signal, Slot, QThread
+from PySide6.QtCore import QObject, Signal, Slot, QThread, QTimer
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QFileDialog,
     QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton,
@@ -12,8 +14,7 @@ import core
 
 
 class Worker(QObject):
-    log = Signal(str)
-    progress = Signal(int)
+    # 日志与进度不再逐条发信号，而是写入缓冲区，由主线程的定时器批量取走
     finished = Signal()
     error = Signal(str)
 
@@ -24,13 +25,64 @@ class Worker(QObject):
         self.output_dir = output_dir
         self.selected_sources = selected_sources
         self.groups = groups
-        self._cancel = False
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._pending_logs = []
+        self._source_progress = {}
+        self._progress = 0
 
     def cancel(self):
-        self._cancel = True
+        self._cancel.set()
 
     def is_cancelled(self):
-        return self._cancel
+        return self._cancel.is_set()
+
+    def drain(self):
+        # 由主线程调用：取走积压的日志与当前进度
+        with self._lock:
+            logs, self._pending_logs = self._pending_logs, []
+            return logs, self._progress
+
+    def _log(self, s: str):
+        with self._lock:
+            self._pending_logs.append(s)
+
+    def _update_progress(self, source: str, p: int):
+        # 每个 source 占 0-100，全局进度为所有 source 的平均值
+        with self._lock:
+            self._source_progress[source] = p
+            total = sum(self._source_progress.values())
+            self._progress = min(100, int(total / max(len(self.selected_sources), 1)))
+
+    def _sort_source(self, source: str):
+        files = self.groups.get(source, [])
+        self._log(f"\n🎯 Processing data source: {source} ({len(files)} images)")
+
+        image_paths = core.sort_images_by_alpha(
+            files,
+            self.emd_dir,
+            log_cb=self._log,
+            progress_cb=lambda p: self._update_progress(source, p),
+            cancel_flag=self.is_cancelled,
+            cache_path=self.output_dir / ".alpha_cache.json"
+        )
+
+        if image_paths is None and not self.is_cancelled():
+            self._log(f"⚠️ Invalid data source, skipping: {source}")
+        return image_paths
+
+    def _write_source(self, source: str, image_paths: list):
+        if self.is_cancelled():
+            return
+
+        out_name = source.replace(" ", "_")
+        out_path = self.output_dir / f"{out_name}.mrc"
+        if not core.stream_to_mrc(image_paths, out_path,
+                                  progress_cb=lambda p: self._update_progress(source, p),
+                                  cancel_flag=self.is_cancelled):
+            return
+        self._update_progress(source, 100)
+        self._log(f"✅ Successfully generated: {out_path}")
 
     @Slot()
     def run(self):
@@ -40,39 +92,35 @@ class Worker(QObject):
                 self.error.emit("No data sources selected.")
                 return
 
-            for i, source in enumerate(self.selected_sources):
+            # 先依次确定各 source 的帧顺序：同一批 EMD 常被多个 source（如 HAADF / DF4）共享，
+            # 依次处理时后面的 source 直接命中 AlphaTilt 缓存，每个 EMD 只打开一次
+            sorted_sources = []
+            for source in self.selected_sources:
                 if self.is_cancelled():
-                    self.log.emit("🛑 Cancelled.")
                     break
-
-                files = self.groups.get(source, [])
-                self.log.emit(f"\n🎯 Processing data source: {source} ({len(files)} images)")
-
-                # 将每个 source 的进度映射到全局进度
-                def progress_cb(p):
-                    # p 是 0-100（单组），映射到全局
-                    base = int(i / total_sources * 100)
-                    span = int(1 / total_sources * 100)
-                    self.progress.emit(min(100, base + int(p / 100 * span)))
-
-                stack = core.load_images_sorted_by_alpha(
-                    files,
-                    self.emd_dir,
-                    log_cb=lambda s: self.log.emit(s),
-                    progress_cb=progress_cb,
-                    cancel_flag=self.is_cancelled
-                )
-
-                if stack is None:
-                    self.log.emit("⚠️ Invalid data source, skipping.")
-                    continue
-
-                out_name = source.replace(" ", "_")
-                out_path = self.output_dir / f"{out_name}.mrc"
-                core.write_mrc(stack, out_path)
-                self.log.emit(f"✅ Successfully generated: {out_path}")
-
-            self.progress.emit(100)
+                image_paths = self._sort_source(source)
+                if image_paths is not None:
+                    sorted_sources.append((source, image_paths))
+
+            # 各 source 的解码与写入相互独立，且以 I/O 为主，并行处理；
+            # 任一 source 出错时取消其余任务并立即上报
+            if sorted_sources and not self.is_cancelled():
+                with ThreadPoolExecutor(max_workers=min(8, len(sorted_sources))) as ex:
+                    futures = [ex.submit(self._write_source, source, image_paths)
+                               for source, image_paths in sorted_sources]
+                    try:
+                        for fut in as_completed(futures):
+                            fut.result()
+                    except Exception:
+                        self._cancel.set()
+                        ex.shutdown(wait=False, cancel_futures=True)
+                        raise
+
+            if self.is_cancelled():
+                self._log("🛑 Cancelled.")
+
+            with self._lock:
+                self._progress = 100
             self.finished.emit()
 
         except Exception as e:
@@ -88,6 +136,11 @@ class MainWindow(QMainWindow):
         self.thread = None
         self.worker = None
 
+        # 定时从 worker 批量取日志/进度，避免界面被大量跨线程信号拖慢
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setInterval(100)
+        self.flush_timer.timeout.connect(self.flush_worker)
+
         root = QWidget()
         self.setCentralWidget(root)
         layout = QVBoxLayout(root)
@@ -164,6 +217,15 @@ class MainWindow(QMainWindow):
     def append_log(self, s: str):
         self.log.append(s)
 
+    @Slot()
+    def flush_worker(self):
+        if self.worker is None:
+            return
+        logs, pct = self.worker.drain()
+        if logs:
+            self.append_log("\n".join(logs))
+        self.progress.setValue(pct)
+
     @Slot()
     def scan_sources(self):
         image_dir = Path(self.image_edit.text().strip())
@@ -223,12 +285,11 @@ class MainWindow(QMainWindow):
         self.worker.moveToThread(self.thread)
 
         self.thread.started.connect(self.worker.run)
-        self.worker.log.connect(self.append_log)
-        self.worker.progress.connect(self.progress.setValue)
         self.worker.finished.connect(self.on_finished)
         self.worker.error.connect(self.on_error)
 
         self.thread.start()
+        self.flush_timer.start()
         self.append_log("▶ Generating")
 
     @Slot()
@@ -239,17 +300,20 @@ class MainWindow(QMainWindow):
 
     @Slot()
     def on_finished(self):
+        self.flush_worker()
         self.append_log("\n🎉 Completed")
         self.cleanup_thread()
         QMessageBox.information(self, "Complete", "MRC generation is complete.")
 
     @Slot(str)
     def on_error(self, msg: str):
+        self.flush_worker()
         self.append_log(f"❌ Error: {msg}")
         self.cleanup_thread()
         QMessageBox.critical(self, "Error", msg)
 
     def cleanup_thread(self):
+        self.flush_timer.stop()
         self.cancel_btn.setEnabled(False)
         self.run_btn.setEnabled(True)
         self.scan_btn.setEnabled(True)
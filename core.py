@@ -1,14 +1,93 @@
+import functools
+import json
+import os
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import h5py
 import numpy as np
 from pathlib import Path
 from PIL import Image
 import mrcfile
 
+try:
+    import cv2  # 可选：OpenCV 的 C 层解码比 PIL convert("F") 更快
+except ImportError:
+    cv2 = None
+
+try:
+    import tifffile  # 可选：TIFF 直接解码为 ndarray
+except ImportError:
+    tifffile = None
+
+try:
+    from turbojpeg import TurboJPEG, TJCS_GRAY, TJPF_GRAY  # 可选：libjpeg-turbo 解码灰度 JPEG
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
+
 # ============================================================
 # 1. Extract AlphaTilt from EMD (compatible with Metadata / AcquisitionMetadata)
 # ============================================================
-def extract_alpha_tilt_from_emd(emd_path: Path):
+# 仅作为未知文件布局时的兜底
+# 直接在 bytes 上匹配，无需把整个 metadata 解码为 str（"\xe2\x88\x92" 为 UTF-8 的 "−"）
+_ALPHA_RE = re.compile(rb'"alphatilt"\s*:\s*"?((?:\xe2\x88\x92)?-?\d+\.?\d*)"?', re.IGNORECASE)
+
+
+def _parse_metadata_json(ds: h5py.Dataset) -> dict:
+    # Velox 的 Metadata 为 uint8 数组，每列对应一帧，取第一帧即可
+    raw = ds[:, 0] if ds.ndim == 2 else ds[()]
+    text = np.asarray(raw).tobytes().rstrip(b"\x00").decode("utf-8", errors="ignore")
+    return json.loads(text)
+
+
+def _read_alpha_tilt_direct(f: h5py.File):
+    # Velox 布局：/Data/<kind>/<uid>/Metadata（JSON），优先 Image，其次 SpectrumImage 等；
+    # 只遍历这两层已知的 group，不递归整个文件
+    data = f.get("Data")
+    if not isinstance(data, h5py.Group):
+        return None
+
+    kinds = sorted(data, key=lambda k: k != "Image")
+    for kind in kinds:
+        grp = data[kind]
+        if not isinstance(grp, h5py.Group):
+            continue
+        for uid in grp:
+            item = grp[uid]
+            if not isinstance(item, h5py.Group):
+                continue
+            md = item.get("Metadata")
+            if not isinstance(md, h5py.Dataset):
+                continue
+            try:
+                meta = _parse_metadata_json(md)
+                return float(str(meta["Stage"]["AlphaTilt"]).replace("−", "-"))
+            except (OSError, ValueError, KeyError, TypeError):
+                # OSError：如 Metadata 使用了不可用的压缩 filter；继续尝试下一个 uid 与 visititems 兜底
+                continue
+
+    return None
+
+
+_METADATA_PREFIX_BYTES = 64 * 1024
+
+
+def _to_bytes(raw) -> bytes:
+    return raw.tobytes() if hasattr(raw, "tobytes") else bytes(raw)
+
+
+def _read_prefix(ds: h5py.Dataset, nbytes: int):
+    # 按第一维切片读取约 nbytes 字节，返回 (数据, 是否只读了一部分)
+    if ds.ndim == 0 or ds.shape[0] == 0:
+        return ds[()], False
+    row_bytes = max(1, ds.dtype.itemsize * (ds.size // ds.shape[0]))
+    rows = max(1, nbytes // row_bytes)
+    return ds[:rows], rows < ds.shape[0]
+
+
+def _read_alpha_tilt(emd_path: Path):
     alpha_tilt = None
 
     def visitor(name, obj):
@@ -23,101 +102,419 @@ def extract_alpha_tilt_from_emd(emd_path: Path):
             return
 
         try:
-            raw = obj[()]
-            text = raw.flatten().tobytes().decode("utf-8", errors="ignore")
-            match = re.search(r'"alphatilt"\s*:\s*"?(−?-?\d+\.?\d*)"?', text, re.IGNORECASE)
+            # 先只读开头一小段（Stage 信息通常在前部），找不到再读取整个 dataset
+            raw, partial = _read_prefix(obj, _METADATA_PREFIX_BYTES)
+            buf = _to_bytes(raw)
+            match = _ALPHA_RE.search(buf)
+            # 匹配一直延伸到前缀末尾时，数字可能被截断，必须读取完整 dataset 重新匹配
+            if partial and (match is None or match.end() >= len(buf)):
+                match = _ALPHA_RE.search(_to_bytes(obj[()]))
             if match:
-                alpha_tilt = float(match.group(1))
+                alpha_tilt = float(match.group(1).replace(b"\xe2\x88\x92", b"-"))
         except Exception:
             pass
 
     with h5py.File(emd_path, "r") as f:
-        f.visititems(visitor)
+        alpha_tilt = _read_alpha_tilt_direct(f)
+        if alpha_tilt is None:
+            f.visititems(visitor)
 
     return alpha_tilt
 
+
+# AlphaTilt 只取决于文件内容，按 (path, mtime, size) 缓存：
+# 进程内为 _alpha_cache，跨运行则持久化到 JSON 文件
+_alpha_cache = {}
+_alpha_cache_lock = threading.Lock()
+
+
+def _alpha_cache_key(emd_path: Path) -> str:
+    # 一次 stat()；abspath 为纯字符串运算，不像 resolve() 那样逐级 lstat
+    st = emd_path.stat()
+    return f"{os.path.normcase(os.path.abspath(emd_path))}|{st.st_mtime_ns}|{st.st_size}"
+
+
+def load_alpha_cache(cache_path: Path):
+    try:
+        data = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return
+    if not isinstance(data, dict):
+        return
+    with _alpha_cache_lock:
+        for key, alpha in data.items():
+            if isinstance(alpha, (int, float)):
+                _alpha_cache[key] = float(alpha)
+
+
+def save_alpha_cache(cache_path: Path):
+    with _alpha_cache_lock:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(_alpha_cache), encoding="utf-8")
+        os.replace(tmp_path, cache_path)
+
+
+def _cached_alpha_tilt(key: str):
+    with _alpha_cache_lock:
+        return _alpha_cache.get(key)
+
+
+def extract_alpha_tilt_from_emd(emd_path: Path, cache_key: str | None = None):
+    # cache_key 可由调用方预先算好传入，避免对同一个 EMD 重复 stat()
+    key = cache_key if cache_key is not None else _alpha_cache_key(emd_path)
+    alpha_tilt = _cached_alpha_tilt(key)
+    if alpha_tilt is not None:
+        return alpha_tilt
+
+    alpha_tilt = _read_alpha_tilt(emd_path)
+    if alpha_tilt is not None:
+        with _alpha_cache_lock:
+            _alpha_cache[key] = alpha_tilt
+    return alpha_tilt
+
+
+# HDF5 的 superblock 与对象头通常位于文件开头。h5py 内部用全局锁串行化所有 HDF5 调用，
+# 因此在打开之前先对一批文件发起异步预读（posix_fadvise，仅 Linux 等平台可用），
+# 让磁盘队列在 h5py 逐个打开文件时已经有请求在途
+_PREFETCH_BYTES = 1 << 20
+
+
+def _prefetch_emd_heads(emd_paths):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for emd_path in emd_paths:
+        try:
+            fd = os.open(emd_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, _PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
 # ============================================================
 # 2. Extract data source from filename
 # ============================================================
+@functools.lru_cache(maxsize=None)
 def extract_source_from_filename(filename: str) -> str:
-    stem = Path(filename).stem
-    tokens = stem.split()
+    # 与 Path(filename).stem.split()[-1] 等价，但直接操作字符串
+    dot = filename.rfind(".")
+    stem = filename[:dot] if dot > 0 else filename
+    tokens = stem.rsplit(None, 1)
     return tokens[-1] if tokens else ""
 
 # ============================================================
 # 3. Group images by source
 # ============================================================
-def group_images_by_source(image_dir: Path):
-    images = []
-    for ext in ("*.png", "*.jpg", "*.jpeg", "*.tif", "*.tiff"):
-        images.extend(image_dir.glob(ext))
+_IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg", ".tif", ".tiff"})
 
+
+def group_images_by_source(image_dir: Path):
+    # 单次 scandir 遍历目录，只为匹配的文件构造 Path
     groups = {}
-    for img in images:
-        source = extract_source_from_filename(img.name)
-        groups.setdefault(source, []).append(img)
+    with os.scandir(image_dir) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in _IMAGE_EXTS:
+                continue
+            source = extract_source_from_filename(entry.name)
+            groups.setdefault(source, []).append(Path(entry.path))
 
     return groups
 
 # ============================================================
 # 4. Find matching EMD for a given image
 # ============================================================
-def find_matching_emd(img_path: Path, emd_dir: Path):
+def _is_case_insensitive(dir_path: Path, name: str) -> bool:
+    # 用目录中已有的文件探测：大小写互换后的名字若指向同一个文件，则文件系统不区分大小写
+    swapped = name.swapcase()
+    if swapped == name:
+        return False
+    try:
+        return os.path.samefile(os.path.join(dir_path, name), os.path.join(dir_path, swapped))
+    except OSError:
+        return False
+
+
+class _EmdIndex:
+    # stem -> EMD 路径；在不区分大小写的文件系统（Windows、默认的 macOS）上按 casefold 匹配，
+    # 与逐个 exists() 的行为一致
+    def __init__(self, paths: dict, case_insensitive: bool):
+        self._case_insensitive = case_insensitive
+        self._paths = {self._key(stem): path for stem, path in paths.items()}
+
+    def _key(self, stem: str) -> str:
+        return stem.casefold() if self._case_insensitive else stem
+
+    def get(self, stem: str):
+        return self._paths.get(self._key(stem))
+
+
+def index_emd_dir(emd_dir: Path):
+    # 一次列出目录中的所有 EMD，之后按 stem 查找，无需对每张图像 stat()
+    paths = {}
+    with os.scandir(emd_dir) as it:
+        for entry in it:
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() == ".emd" and entry.is_file():
+                paths[stem] = Path(entry.path)
+
+    case_insensitive = bool(paths) and _is_case_insensitive(emd_dir, next(iter(paths.values())).name)
+    return _EmdIndex(paths, case_insensitive)
+
+
+def find_matching_emd(img_path: Path, emd_dir: Path, emd_index=None):
     stem = img_path.stem
     tokens = stem.split()
     if len(tokens) < 2:
         return None
     emd_stem = " ".join(tokens[:-1])
+    if emd_index is not None:
+        return emd_index.get(emd_stem)
     emd_path = emd_dir / f"{emd_stem}.emd"
     return emd_path if emd_path.exists() else None
 
 # ============================================================
 # 5. Load images sorted by AlphaTilt
 # ============================================================
-def load_images_sorted_by_alpha(image_files, emd_dir: Path, log_cb=None, progress_cb=None, cancel_flag=None):
-    records = []
-    total = len(image_files)
+_SINGLE_CHANNEL_MODES = frozenset({"L", "I;16", "I", "F"})
+
+
+def _decode_image(img_path: Path):
+    # 按后缀选择最快的可用解码器，失败时依次回退到 OpenCV / PIL
+    suffix = img_path.suffix.lower()
+    if _turbojpeg is not None and suffix in (".jpg", ".jpeg"):
+        # 只处理灰度 JPEG：彩色 JPEG 的 TJPF_GRAY 是量化后的 Y 平面，
+        # 与 PIL 由 RGB 计算的浮点亮度不同，交给后面的 PIL 路径
+        try:
+            with open(img_path, "rb") as fh:
+                buf = fh.read()
+            if _turbojpeg.decode_header(buf)[3] == TJCS_GRAY:
+                img = _turbojpeg.decode(buf, pixel_format=TJPF_GRAY)
+                return img[..., 0].astype(np.float32)
+        except (OSError, ValueError):
+            pass
+    if tifffile is not None and suffix in (".tif", ".tiff"):
+        # tifffile 返回原始采样值，不处理 photometric 解释：只接受多比特的 MinIsBlack 单通道图像，
+        # 二值 / 调色板 / MinIsWhite 等 TIFF 交给后面的 OpenCV / PIL
+        try:
+            with tifffile.TiffFile(img_path) as tif:
+                page = tif.pages[0]
+                if (page.photometric == tifffile.PHOTOMETRIC.MINISBLACK
+                        and page.samplesperpixel == 1 and page.bitspersample > 1):
+                    img = page.asarray()
+                    if img.ndim == 2:
+                        return img.astype(np.float32, copy=False)
+        except (OSError, ValueError):
+            pass
+
+    if cv2 is not None:
+        # 只接受原本就是单通道的图像：OpenCV 的灰度转换会先量化到 uint8，
+        # 与 convert("F") 的浮点亮度不一致，彩色/调色板/RGBA 图像交给 PIL
+        img = cv2.imread(str(img_path), cv2.IMREAD_UNCHANGED)
+        if img is not None and img.ndim == 2:
+            return img.astype(np.float32, copy=False)
+    # 未安装 OpenCV、其无法读取（如 Windows 下的非 ASCII 路径）或为多通道图像时回退到 PIL
+    with Image.open(img_path) as im:
+        # 单通道图像由 NumPy 直接转换为 float32，比 PIL 的 convert("F") 更快
+        if im.mode in _SINGLE_CHANNEL_MODES:
+            return np.asarray(im, dtype=np.float32)
+        return np.asarray(im.convert("F"), dtype=np.float32)
+
+
+def _make_reporter(progress_cb, base: int, n: int):
+    # 线程安全的计数器：每完成一项，把进度映射到 [base, base + 50]
+    # 只在整数百分比变化时回调，避免大量无意义的跨线程信号
+    lock = threading.Lock()
+    done = 0
+    last_pct = -1
+
+    def report():
+        nonlocal done, last_pct
+        if not progress_cb:
+            return
+        with lock:
+            done += 1
+            p = base + int(done / max(n, 1) * 50)
+            if p == last_pct:
+                return
+            last_pct = p
+            # 在锁内回调，保证多个线程上报的进度单调递增
+            progress_cb(p)
+
+    return report
+
+
+_DECODE_QUEUE_SIZE = 8
+
+
+def _decode_into(out, image_paths, progress_cb=None, cancel_flag=None):
+    # 生产者-消费者：多个解码线程把 float32 帧放入有界队列，调用线程作为唯一的写入者
+    # 依次写入 out[j]（可以是内存映射的 MRC），使磁盘写入与后续帧的解码重叠
+    n = len(image_paths)
+    report = _make_reporter(progress_cb, 50, n)  # then read image stack
+
+    tasks = queue.Queue()
+    for j, img_path in enumerate(image_paths):
+        tasks.put((j, img_path))
+    results = queue.Queue(maxsize=_DECODE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def cancelled():
+        return cancel_flag is not None and cancel_flag()
+
+    def decoder():
+        while not stop.is_set() and not cancelled():
+            try:
+                j, img_path = tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                results.put((j, _decode_image(img_path)))
+            except Exception as e:
+                results.put((j, e))
+                break
+        results.put(None)
 
-    for idx, img_path in enumerate(image_files):
-        if cancel_flag is not None and cancel_flag():
-            return None
+    n_workers = max(1, min(os.cpu_count() or 1, n))
+    workers = [threading.Thread(target=decoder, daemon=True) for _ in range(n_workers)]
+    for w in workers:
+        w.start()
 
-        emd_path = find_matching_emd(img_path, emd_dir)
+    error = None
+    written = 0
+    finished = 0
+    # 出错或取消后继续取空队列，直到所有解码线程退出，避免其阻塞在 put 上
+    while finished < n_workers:
+        item = results.get()
+        if item is None:
+            finished += 1
+            continue
+        if stop.is_set():
+            continue
+        j, frame = item
+        try:
+            if isinstance(frame, Exception):
+                raise frame
+            # 逐帧赋值会触发广播（如 1×W 的帧被复制到整帧），这里显式检查尺寸
+            if frame.shape != out.shape[1:]:
+                raise ValueError(
+                    f"Image size mismatch: {image_paths[j]} has shape {frame.shape}, expected {out.shape[1:]}")
+            out[j] = frame
+        except Exception as e:
+            error = e
+            stop.set()
+            continue
+        written += 1
+        report()
+
+    for w in workers:
+        w.join()
+
+    if error is not None:
+        raise error
+    return written == n and not cancelled()
+
+
+def _stack_shape(image_paths):
+    with Image.open(image_paths[0]) as first:
+        w, h = first.size
+    return len(image_paths), h, w
+
+
+def sort_images_by_alpha(image_files, emd_dir: Path, log_cb=None, progress_cb=None, cancel_flag=None,
+                         cache_path: Path = None):
+    # 多张图像可能来自同一个 EMD：按 EMD 分组，每个文件只打开一次
+    emd_index = index_emd_dir(emd_dir)
+    emd_to_imgs = {}
+    for img_path in image_files:
+        emd_path = find_matching_emd(img_path, emd_dir, emd_index)
         if emd_path is None:
             if log_cb: log_cb(f"⚠️ EMD not found for: {img_path.name}")
             continue
+        emd_to_imgs.setdefault(emd_path, []).append(img_path)
+
+    if cache_path is not None:
+        load_alpha_cache(cache_path)
+
+    emd_paths = list(emd_to_imgs)
+    # 每个 EMD 只计算一次缓存键（一次 stat），预读过滤与提取共用
+    cache_keys = {p: _alpha_cache_key(p) for p in emd_paths}
+    _prefetch_emd_heads([p for p in emd_paths if _cached_alpha_tilt(cache_keys[p]) is None])
+    report = _make_reporter(progress_cb, 0, len(emd_paths))  # first collect tilt
 
-        alpha = extract_alpha_tilt_from_emd(emd_path)
+    # 所有 EMD 一次性提交，按完成顺序收集结果；取消时丢弃尚未开始的任务
+    alphas = {}
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = {ex.submit(extract_alpha_tilt_from_emd, p, cache_keys[p]): p for p in emd_paths}
+        for fut in as_completed(futures):
+            if cancel_flag is not None and cancel_flag():
+                for pending in futures:
+                    pending.cancel()
+                break
+            alphas[futures[fut]] = fut.result()
+            report()
+
+    if cache_path is not None:
+        save_alpha_cache(cache_path)
+    if cancel_flag is not None and cancel_flag():
+        return None
+
+    records = []
+    for emd_path in emd_paths:
+        alpha = alphas.get(emd_path)
         if alpha is None:
             if log_cb: log_cb(f"⚠️ AlphaTilt not found for: {emd_path.name}")
             continue
-
-        records.append((alpha, img_path))
-
-        if progress_cb:
-            progress_cb(int((idx + 1) / max(total, 1) * 50))  # first collect tilt
+        records.extend((alpha, img_path) for img_path in emd_to_imgs[emd_path])
 
     if not records:
         return None
 
-    records.sort(key=lambda x: x[0])
+    tilts = np.fromiter((alpha for alpha, _ in records), dtype=np.float64, count=len(records))
+    order = np.argsort(tilts, kind="stable")
+    return [records[i][1] for i in order]
 
-    stack = []
-    for j, (alpha, img_path) in enumerate(records):
-        if cancel_flag is not None and cancel_flag():
-            return None
 
-        img = Image.open(img_path).convert("F")
-        stack.append(np.array(img))
-
-        if progress_cb:
-            # then read image stack
-            progress_cb(50 + int((j + 1) / max(len(records), 1) * 50))
+def load_images_sorted_by_alpha(image_files, emd_dir: Path, log_cb=None, progress_cb=None, cancel_flag=None,
+                                cache_path: Path = None):
+    image_paths = sort_images_by_alpha(image_files, emd_dir, log_cb, progress_cb, cancel_flag, cache_path)
+    if image_paths is None:
+        return None
 
-    return np.stack(stack, axis=0)
+    # 预先分配 float32 的整块 stack，逐帧解码写入，避免 np.stack / astype 的整块拷贝
+    stack = np.empty(_stack_shape(image_paths), dtype=np.float32)
+    if not _decode_into(stack, image_paths, progress_cb, cancel_flag):
+        return None
+    return stack
 
 
 def write_mrc(stack: np.ndarray, output_path: Path):
     output_path.parent.mkdir(parents=True, exist_ok=True)
     with mrcfile.new(str(output_path), overwrite=True) as mrc:
-        mrc.set_data(stack.astype(np.float32))
+        # float32 数组原样传入；帧列表等输入也只做一次分配
+        mrc.set_data(np.asarray(stack, dtype=np.float32))
+
+
+def stream_to_mrc(image_paths, output_path: Path, progress_cb=None, cancel_flag=None):
+    # 直接解码到内存映射的 MRC 中（mode 2 = float32），不再在内存中持有整个 stack。
+    # 先写入同目录的临时文件，成功后再替换 output_path：取消或出错时保留已有的旧输出
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    shape = _stack_shape(image_paths)
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    ok = False
+    try:
+        with mrcfile.new_mmap(str(tmp_path), shape=shape, mrc_mode=2, overwrite=True) as mrc:
+            ok = _decode_into(mrc.data, image_paths, progress_cb, cancel_flag)
+            if ok:
+                mrc.update_header_stats()
+        if ok:
+            os.replace(tmp_path, output_path)
+    finally:
+        if not ok:
+            tmp_path.unlink(missing_ok=True)
+    return ok